@@ -1,12 +1,27 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 
 from routers import auth, bot_config, orders
 
 load_dotenv()
 
-app = FastAPI(title="Chel3D API", description="API для заявок Chel3D")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await orders.http_client.aclose()
+
+
+app = FastAPI(
+    title="Chel3D API",
+    description="API для заявок Chel3D",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -1,4 +1,6 @@
 import datetime
+import time
+from functools import lru_cache
 
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
@@ -22,11 +24,21 @@ def create_access_token(data: dict):
     return jwt.encode(to_encode, settings.secret_key, algorithm=ALGORITHM)
 
 
+@lru_cache(maxsize=4096)
+def _decode(token: str) -> dict:
+    return jwt.decode(token, settings.secret_key, algorithms=[ALGORITHM])
+
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
-        return jwt.decode(credentials.credentials, settings.secret_key, algorithms=[ALGORITHM])
+        payload = _decode(credentials.credentials)
     except JWTError as exc:
         raise HTTPException(status_code=401, detail="Недействительный токен") from exc
+    # cached payloads skip jose's own expiry check, so re-check it here
+    exp = payload.get("exp")
+    if exp is not None and exp <= time.time():
+        raise HTTPException(status_code=401, detail="Недействительный токен")
+    return payload
 
 
 @router.post("/login")
@@ -1,9 +1,13 @@
 import logging
-from typing import Any
+import time
+from typing import Any, Callable
 
-from fastapi import APIRouter, Depends, HTTPException
+import httpx
+import orjson
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response
 
 import database
+from config import settings
 from routers.auth import verify_token
 
 router = APIRouter()
@@ -101,30 +105,97 @@ SETTINGS_KEYS: list[str] = [
     "placeholder_photo_path",
 ] + TOGGLE_KEYS
 
+TEXT_KEYS = list(dict.fromkeys(TEXT_KEYS))
+TEXT_KEY_SET = frozenset(TEXT_KEYS)
+TOGGLE_KEY_SET = frozenset(TOGGLE_KEYS)
+SETTINGS_KEY_SET = frozenset(SETTINGS_KEYS)
+ALL_SETTINGS_KEYS = tuple(dict.fromkeys(SETTINGS_KEYS + PHOTO_KEYS))
+
+
+CACHE_TTL_SECONDS = 15.0
+
+_cache: dict[str, tuple[float, str, Any]] = {}
+
+
+def _cached(name: str, ttl: float, builder: Callable[[], Any]) -> Any:
+    hit = _cache.get(name)
+    now = time.monotonic()
+    if hit is not None and now - hit[0] < ttl:
+        return hit[2]
+    # TTL expired: revalidate against the cheap version token before rebuilding
+    version = database.get_bot_config_version()
+    if hit is not None and hit[1] == version:
+        _cache[name] = (now, version, hit[2])
+        return hit[2]
+    value = builder()
+    _cache[name] = (now, version, value)
+    return value
+
+
+def _notify_bot_reload() -> None:
+    # runs as a BackgroundTask after the response: a slow or down bot does not delay the save
+    try:
+        response = httpx.post(
+            "http://bot:8081/internal/reloadConfig",
+            headers={"X-Internal-Key": settings.internal_api_key},
+            timeout=2,
+        )
+        response.raise_for_status()
+    except Exception:
+        logger.warning("Не удалось уведомить бота об изменении настроек", exc_info=True)
+
 
 def _clean_str(v: Any) -> str:
+    if type(v) is str:
+        return v
     return "" if v is None else str(v)
 
 
+_TRUTHY = frozenset({"1", "true", "yes", "on", "True", "TRUE", "Yes", "YES", "On", "ON"})
+
+
 def _bool_from_cfg(v: Any, default: bool = True) -> bool:
     if v is None or v == "":
         return default
-    return str(v).strip().lower() in {"1", "true", "yes", "on"}
+    if v in _TRUTHY:
+        return True
+    return str(v).strip().lower() in _TRUTHY
 
 
 def _bool_to_str(v: Any) -> str:
     return "true" if bool(v) else "false"
 
 
+def _build_texts() -> bytes:
+    cfg = database.get_bot_config_subset(TEXT_KEYS)
+    return orjson.dumps({k: cfg.get(k, "") for k in TEXT_KEYS})
+
+
+def _build_settings() -> bytes:
+    cfg = database.get_bot_config_subset(ALL_SETTINGS_KEYS)
+    out: dict[str, Any] = {k: cfg.get(k, "") for k in ALL_SETTINGS_KEYS}
+    for k in TOGGLE_KEYS:
+        out[k] = _bool_from_cfg(out[k], default=True)
+    return orjson.dumps(out)
+
+
 @router.get("/")
-async def get_bot_config(payload: dict = Depends(verify_token)) -> dict[str, Any]:
-    return database.get_bot_config()
+def get_bot_config(payload: dict = Depends(verify_token)) -> dict[str, Any]:
+    return _cached("config", CACHE_TTL_SECONDS, database.get_bot_config)
 
 
 @router.put("/")
-async def update_bot_config(data: dict[str, Any], payload: dict = Depends(verify_token)) -> dict[str, str]:
+def update_bot_config(
+    data: dict[str, Any],
+    background_tasks: BackgroundTasks,
+    payload: dict = Depends(verify_token),
+) -> dict[str, str]:
     try:
-        database.set_bot_config_many({str(k): _clean_str(v) for k, v in (data or {}).items()})
+        if not data:
+            return {"message": "Настройки сохранены"}
+        database.set_bot_config_many({k: _clean_str(v) for k, v in data.items()})
+        _cache.clear()
+        background_tasks.add_task(_notify_bot_reload)
         return {"message": "Настройки сохранены"}
     except Exception as exc:
         logger.exception("Ошибка сохранения настроек бота")
@@ -132,19 +203,24 @@ async def update_bot_config(data: dict[str, Any], payload: dict = Depends(verify
 
 
 @router.get("/texts")
-async def get_bot_texts(payload: dict = Depends(verify_token)) -> dict[str, str]:
-    cfg = database.get_bot_config()
-    return {k: cfg.get(k, "") for k in TEXT_KEYS}
+def get_bot_texts(payload: dict = Depends(verify_token)) -> Response:
+    return Response(_cached("texts", CACHE_TTL_SECONDS, _build_texts), media_type="application/json")
 
 
 @router.put("/texts")
-async def update_bot_texts(data: dict[str, Any], payload: dict = Depends(verify_token)) -> dict[str, str]:
+def update_bot_texts(
+    data: dict[str, Any],
+    background_tasks: BackgroundTasks,
+    payload: dict = Depends(verify_token),
+) -> dict[str, str]:
     try:
-        to_save: dict[str, str] = {}
-        for k in TEXT_KEYS:
-            if k in (data or {}):
-                to_save[k] = _clean_str(data.get(k))
+        data = data or {}
+        to_save = {k: _clean_str(data[k]) for k in TEXT_KEY_SET & data.keys()}
+        if not to_save:
+            return {"message": "Тексты сохранены"}
         database.set_bot_config_many(to_save)
+        _cache.clear()
+        background_tasks.add_task(_notify_bot_reload)
         return {"message": "Тексты сохранены"}
     except Exception as exc:
         logger.exception("Ошибка сохранения текстов бота")
@@ -152,27 +228,27 @@ async def update_bot_texts(data: dict[str, Any], payload: dict = Depends(verify_
 
 
 @router.get("/settings")
-async def get_bot_settings(payload: dict = Depends(verify_token)) -> dict[str, Any]:
-    cfg = database.get_bot_config()
-    keys = SETTINGS_KEYS + PHOTO_KEYS
-    out: dict[str, Any] = {k: cfg.get(k, "") for k in keys}
-    for k in TOGGLE_KEYS:
-        out[k] = _bool_from_cfg(out.get(k, ""), default=True)
-    return out
+def get_bot_settings(payload: dict = Depends(verify_token)) -> Response:
+    return Response(_cached("settings", CACHE_TTL_SECONDS, _build_settings), media_type="application/json")
 
 
 @router.put("/settings")
-async def update_bot_settings(data: dict[str, Any], payload: dict = Depends(verify_token)) -> dict[str, str]:
+def update_bot_settings(
+    data: dict[str, Any],
+    background_tasks: BackgroundTasks,
+    payload: dict = Depends(verify_token),
+) -> dict[str, str]:
     try:
-        to_save: dict[str, str] = {}
-        for k in SETTINGS_KEYS:
-            if k not in (data or {}):
-                continue
-            if k in TOGGLE_KEYS:
-                to_save[k] = _bool_to_str(data.get(k))
-            else:
-                to_save[k] = _clean_str(data.get(k))
+        data = data or {}
+        to_save = {
+            k: _bool_to_str(data[k]) if k in TOGGLE_KEY_SET else _clean_str(data[k])
+            for k in SETTINGS_KEY_SET & data.keys()
+        }
+        if not to_save:
+            return {"message": "Настройки сохранены"}
         database.set_bot_config_many(to_save)
+        _cache.clear()
+        background_tasks.add_task(_notify_bot_reload)
         return {"message": "Настройки сохранены"}
     except Exception as exc:
         logger.exception("Ошибка сохранения настроек бота")
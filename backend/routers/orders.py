@@ -1,7 +1,11 @@
+import asyncio
 import logging
 
 import httpx
+import orjson
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 import database
@@ -11,14 +15,11 @@ from routers.auth import verify_token
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-STATUS_MAP = {
-    "draft": "Черновик",
-    "new": "Новая заявка",
-    "submitted": "Новая заявка",
-    "in_work": "В работе",
-    "done": "Готово",
-    "canceled": "Отменено",
-}
+http_client = httpx.AsyncClient(
+    timeout=20,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+)
+_getfile_semaphore = asyncio.Semaphore(20)
 
 
 class OrderUpdate(BaseModel):
@@ -30,7 +31,7 @@ class MessageCreate(BaseModel):
 
 
 @router.get("/")
-async def get_orders(
+def get_orders(
     page: int = 1,
     limit: int = 200,
     status_filter: str | None = None,
@@ -42,17 +43,14 @@ async def get_orders(
         if limit < 1:
             limit = 20
         offset = (page - 1) * limit
-        orders = database.get_orders_paginated(limit, offset, status_filter)
-        for order in orders:
-            order["status_label"] = STATUS_MAP.get(order.get("status"), order.get("status"))
-        return orders
+        return database.get_orders_paginated(limit, offset, status_filter)
     except Exception as exc:
         logger.exception("Ошибка получения списка заявок")
         raise HTTPException(status_code=500, detail="Ошибка получения списка заявок") from exc
 
 
 @router.get("/stats")
-async def get_order_stats(payload: dict = Depends(verify_token)):
+def get_order_stats(payload: dict = Depends(verify_token)):
     try:
         return database.get_order_statistics()
     except Exception:
@@ -61,16 +59,15 @@ async def get_order_stats(payload: dict = Depends(verify_token)):
 
 
 @router.get("/{order_id}")
-async def get_order(order_id: int, payload: dict = Depends(verify_token)):
+def get_order(order_id: int, payload: dict = Depends(verify_token)):
     order = database.get_order(order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Заявка не найдена")
-    order["status_label"] = STATUS_MAP.get(order.get("status"), order.get("status"))
     return order
 
 
 @router.put("/{order_id}")
-async def update_order(order_id: int, order_update: OrderUpdate, payload: dict = Depends(verify_token)):
+def update_order(order_id: int, order_update: OrderUpdate, payload: dict = Depends(verify_token)):
     current_order = database.get_order(order_id)
     if not current_order:
         raise HTTPException(status_code=404, detail="Заявка не найдена")
@@ -82,36 +79,50 @@ async def update_order(order_id: int, order_update: OrderUpdate, payload: dict =
     return {"message": "Заявка обновлена"}
 
 
+async def _resolve_file(item: dict) -> dict:
+    file_url = None
+    async with _getfile_semaphore:
+        try:
+            resp = await http_client.get(
+                f"https://api.telegram.org/bot{settings.bot_token}/getFile",
+                params={"file_id": item["telegram_file_id"]},
+            )
+            if resp.status_code == 200:
+                data = (resp.json() or {}).get("result", {}) or {}
+                if data.get("file_path"):
+                    file_url = f"https://api.telegram.org/file/bot{settings.bot_token}/{data['file_path']}"
+        except Exception:
+            logger.exception("Ошибка резолва telegram file_id")
+    item["file_url"] = file_url
+    return item
+
+
 @router.get("/{order_id}/files")
 async def get_order_files(order_id: int, payload: dict = Depends(verify_token)):
-    files = database.list_order_files(order_id)
-    result = []
-    async with httpx.AsyncClient(timeout=20) as client:
-        for item in files:
-            file_url = None
-            try:
-                resp = await client.get(
-                    f"https://api.telegram.org/bot{settings.bot_token}/getFile",
-                    params={"file_id": item["telegram_file_id"]},
-                )
-                if resp.status_code == 200:
-                    data = (resp.json() or {}).get("result", {}) or {}
-                    if data.get("file_path"):
-                        file_url = f"https://api.telegram.org/file/bot{settings.bot_token}/{data['file_path']}"
-            except Exception:
-                logger.exception("Ошибка резолва telegram file_id")
-            result.append({**item, "file_url": file_url})
+    files = await run_in_threadpool(database.list_order_files, order_id)
+    result = await asyncio.gather(*map(_resolve_file, files))
     return {"files": result}
 
 
+@router.get("/{order_id}/files/stream")
+async def stream_order_files(order_id: int, payload: dict = Depends(verify_token)):
+    files = await run_in_threadpool(database.list_order_files, order_id)
+
+    async def gen():
+        for fut in asyncio.as_completed([_resolve_file(item) for item in files]):
+            yield orjson.dumps(await fut, default=str) + b"\n"
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+
 @router.get("/{order_id}/messages")
-async def get_messages(order_id: int, payload: dict = Depends(verify_token)):
+def get_messages(order_id: int, payload: dict = Depends(verify_token)):
     return {"messages": database.list_order_messages(order_id, 30)}
 
 
 @router.post("/{order_id}/messages")
 async def send_message(order_id: int, body: MessageCreate, payload: dict = Depends(verify_token)):
-    order = database.get_order(order_id)
+    order = await run_in_threadpool(database.get_order, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Заявка не найдена")
     if order.get("status") == "canceled":
@@ -122,12 +133,11 @@ async def send_message(order_id: int, body: MessageCreate, payload: dict = Depen
         raise HTTPException(status_code=400, detail="Текст сообщения пустой")
 
     try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            response = await client.post(
-                "http://bot:8081/internal/sendMessage",
-                headers={"X-Internal-Key": settings.internal_api_key},
-                json={"user_id": int(order["user_id"]), "text": text, "order_id": int(order_id)},
-            )
+        response = await http_client.post(
+            "http://bot:8081/internal/sendMessage",
+            headers={"X-Internal-Key": settings.internal_api_key},
+            json={"user_id": int(order["user_id"]), "text": text, "order_id": int(order_id)},
+        )
     except Exception as exc:
         logger.exception("Ошибка вызова bot internal API")
         raise HTTPException(status_code=400, detail="Не удалось отправить сообщение в Telegram") from exc
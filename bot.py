@@ -1,16 +1,32 @@
 import asyncio
+import hmac
 import logging
+import os
+import shutil
+import signal
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Callable, Coroutine, Optional
 
+import orjson
 from aiohttp import web
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
 from aiogram.enums import ContentType
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import CommandStart
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import CallbackQuery, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 import database
 from config import settings
@@ -21,6 +37,80 @@ logger = logging.getLogger("chel3d_bot")
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+MAX_PARALLEL_DOWNLOADS = 4
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+REDIS_MAX_CONNECTIONS = 50
+# потоки для db_call: у каждого своё соединение MySQL, так что это и потолок соединений бота
+DB_THREAD_POOL_SIZE = 16
+# незавершённые анкеты в Redis живут сутки, потом ключи удаляются сами
+FSM_TTL = timedelta(days=1)
+DOWNLOAD_TIMEOUT_SECONDS = 120
+
+ATTACHMENT_QUEUE_SIZE = 200
+# (order_id, tg_file_id, file_unique_id, file_name, file_size); разбирают MAX_PARALLEL_DOWNLOADS воркеров
+_attachment_queue: asyncio.Queue[tuple[int, str, str | None, str | None, int | None]] = asyncio.Queue(ATTACHMENT_QUEUE_SIZE)
+_background_tasks: set[asyncio.Task] = set()
+
+# лимиты Bot API: ~30 сообщений/с на бота, 20/мин в группу.
+# Личные чаты окном не ограничиваем: это ответы на нажатия самого пользователя,
+# редкий 429 там закрывает повтор по TelegramRetryAfter
+SEND_LIMIT_GLOBAL = (30, 1.0)
+SEND_LIMIT_GROUP = (20, 60.0)
+SEND_LIMIT_MAX_CHATS = 10_000
+
+
+class SlidingWindow:
+    def __init__(self, limit: int, period: float) -> None:
+        self.limit = limit
+        self.period = period
+        self.stamps: deque[float] = deque()
+        self.lock = asyncio.Lock()
+
+    def idle(self, now: float) -> bool:
+        return not self.stamps or now - self.stamps[-1] >= self.period
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.stamps and now - self.stamps[0] >= self.period:
+                    self.stamps.popleft()
+                if len(self.stamps) < self.limit:
+                    self.stamps.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self.stamps[0]))
+
+
+class SendRateLimiter(BaseRequestMiddleware):
+    def __init__(self) -> None:
+        self.global_window = SlidingWindow(*SEND_LIMIT_GLOBAL)
+        self.chat_windows: dict[int | str, SlidingWindow] = {}
+
+    def _group_window(self, chat_id: int | str) -> SlidingWindow:
+        window = self.chat_windows.get(chat_id)
+        if window is None:
+            if len(self.chat_windows) >= SEND_LIMIT_MAX_CHATS:
+                now = time.monotonic()
+                self.chat_windows = {k: w for k, w in self.chat_windows.items() if not w.idle(now)}
+            window = self.chat_windows[chat_id] = SlidingWindow(*SEND_LIMIT_GROUP)
+        return window
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: Any) -> Any:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # answerCallbackQuery, getFile и т.п. под лимиты сообщений не попадают
+            return await make_request(bot, method)
+        if isinstance(chat_id, str) or chat_id < 0:
+            await self._group_window(chat_id).acquire()
+        await self.global_window.acquire()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            logger.warning("Telegram просит подождать %s с (chat_id=%s)", e.retry_after, chat_id)
+            await asyncio.sleep(e.retry_after)
+            return await make_request(bot, method)
+
 
 def user_full_name(user) -> str:
     first = getattr(user, "first_name", "") or ""
@@ -33,40 +123,110 @@ def user_username(user) -> str | None:
     return getattr(user, "username", None)
 
 
+async def db_call(fn: Callable[..., Any], *args: Any) -> Any:
+    # PyMySQL блокирует поток — выносим запрос из event loop
+    return await asyncio.to_thread(fn, *args)
+
+
+_bot_cfg_cache: tuple[float, dict[str, str]] | None = None
+_bot_cfg_lock = asyncio.Lock()
+
+
+def _bot_cfg_fresh() -> bool:
+    return _bot_cfg_cache is not None and time.monotonic() < _bot_cfg_cache[0]
+
+
+def _clear_cfg_caches() -> None:
+    _kb_cache.clear()
+    _photo_ref_cache.clear()
+    resolve_photo.cache_clear()
+    _uploaded_photo_ids.clear()
+
+
+def _apply_bot_cfg(cfg: dict[str, str]) -> None:
+    global _bot_cfg_cache
+    changed = _bot_cfg_cache is None or _bot_cfg_cache[1] != cfg
+    _bot_cfg_cache = (time.monotonic() + settings.bot_cfg_ttl, cfg)
+    # настройки не менялись — клавиатуры и file_id фото остаются валидными
+    if changed:
+        _clear_cfg_caches()
+        _prebuild_keyboards(cfg)
+
+
 def bot_cfg() -> dict[str, str]:
-    try:
-        return database.get_bot_config()
-    except Exception:
-        return {}
+    # только память: обновляет снимок warm_bot_cfg (middleware, фоновые воркеры), в event loop в БД не ходим
+    return _bot_cfg_cache[1] if _bot_cfg_cache is not None else {}
 
 
-def get_cfg(key: str, default: str = "") -> str:
-    val = bot_cfg().get(key, "")
-    if val is None or val == "":
-        return default
-    return str(val)
+async def warm_bot_cfg() -> None:
+    if _bot_cfg_fresh():
+        return
+    async with _bot_cfg_lock:
+        if _bot_cfg_fresh():
+            return
+        try:
+            cfg = await db_call(database.get_bot_config)
+        except Exception:
+            logger.exception("Не удалось обновить настройки бота")
+            return
+        _apply_bot_cfg(cfg)
+
+
+async def bot_cfg_middleware(
+    handler: Callable[[Any, dict[str, Any]], Coroutine[Any, Any, Any]],
+    event: Any,
+    data: dict[str, Any],
+) -> Any:
+    # снимок настроек обновляем до хендлера, чтобы bot_cfg() не ходил в БД из event loop
+    await warm_bot_cfg()
+    return await handler(event, data)
+
 
+def invalidate_bot_cfg() -> None:
+    global _bot_cfg_cache
+    # старый снимок оставляем до перечитывания, чтобы хендлеры не увидели пустой конфиг
+    if _bot_cfg_cache is not None:
+        _bot_cfg_cache = (0.0, _bot_cfg_cache[1])
+    _clear_cfg_caches()
 
-def cfg_bool(key: str, default: bool = True) -> bool:
-    raw = bot_cfg().get(key, "")
-    if raw is None or raw == "":
+
+_TRUTHY = frozenset({"1", "true", "yes", "on"})
+
+
+def get_cfg(key: str, default: str = "", cfg: dict[str, str] | None = None) -> str:
+    # значения из bot_config уже строки; None и "" — «не задано»
+    return (cfg if cfg is not None else bot_cfg()).get(key) or default
+
+
+def cfg_bool(key: str, default: bool = True, cfg: dict[str, str] | None = None) -> bool:
+    raw = (cfg if cfg is not None else bot_cfg()).get(key)
+    if not raw:
         return default
-    return str(raw).lower() in {"1", "true", "yes", "on"}
+    return raw.lower() in _TRUTHY
 
 
-def photo_ref_for(step_key: str) -> str:
-    cfg = bot_cfg()
-    return (
-        cfg.get(step_key, "")
-        or cfg.get("placeholder_photo_path", "")
-        or getattr(settings, "placeholder_photo_path", "")
-    )
+# step_key -> итоговый ref фото для текущего снимка настроек
+_photo_ref_cache: dict[str, str] = {}
+
+
+def photo_ref_for(step_key: str, cfg: dict[str, str] | None = None) -> str:
+    ref = _photo_ref_cache.get(step_key)
+    if ref is None:
+        if cfg is None:
+            cfg = bot_cfg()
+        ref = _photo_ref_cache[step_key] = (
+            cfg.get(step_key, "")
+            or cfg.get("placeholder_photo_path", "")
+            or getattr(settings, "placeholder_photo_path", "")
+        )
+    return ref
 
 
 def get_orders_chat_id() -> str:
     return get_cfg("orders_chat_id", getattr(settings, "orders_chat_id", ""))
 
 
+@lru_cache(maxsize=16)
 def normalize_chat_id(value: str) -> int | str:
     cleaned = (value or "").strip().replace(" ", "")
     if cleaned.startswith("-") and cleaned[1:].isdigit():
@@ -80,6 +240,23 @@ class Form(StatesGroup):
     step = State()
 
 
+class MenuCB(CallbackData, prefix="menu"):
+    branch: str
+
+
+class NavCB(CallbackData, prefix="nav"):
+    action: str
+
+
+class AboutCB(CallbackData, prefix="about"):
+    section: str
+
+
+class SetCB(CallbackData, prefix="set"):
+    field: str
+    value: str
+
+
 def kb(rows: list[list[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -87,28 +264,104 @@ def kb(rows: list[list[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
 def nav_row(include_back: bool = True) -> list[InlineKeyboardButton]:
     row: list[InlineKeyboardButton] = []
     if include_back:
-        row.append(InlineKeyboardButton(text="🔙 Назад", callback_data="nav:back"))
-    row.append(InlineKeyboardButton(text="🏠 Главное меню", callback_data="nav:menu"))
+        row.append(InlineKeyboardButton(text="🔙 Назад", callback_data=NavCB(action="back").pack()))
+    row.append(InlineKeyboardButton(text="🏠 Главное меню", callback_data=NavCB(action="menu").pack()))
     return row
 
 
-def menu_kb() -> InlineKeyboardMarkup:
+# Клавиатуры, не зависящие от bot_config, собираем один раз при импорте.
+NAV_KB = kb([nav_row()])
+HOME_KB = kb([nav_row(include_back=False)])
+ATTACH_FILE_KB = kb([
+    [InlineKeyboardButton(text="❌ У меня нет файла", callback_data=SetCB(field="file", value="нет").pack())],
+    nav_row(),
+])
+
+
+_kb_cache: dict[str, InlineKeyboardMarkup] = {}
+
+
+def cached_kb(name: str, build: Callable[[dict[str, str]], InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+    # Клавиатуры зависят только от снимка настроек — строим каждую один раз на снимок.
+    cfg = bot_cfg()
+    markup = _kb_cache.get(name)
+    if markup is None:
+        markup = _kb_cache[name] = build(cfg)
+    return markup
+
+
+def _build_menu_kb(cfg: dict[str, str]) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
-    if cfg_bool("enabled_menu_print", True):
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_print", "📐 Рассчитать печать"), callback_data="menu:print")])
-    if cfg_bool("enabled_menu_scan", True):
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_scan", "📡 3D-сканирование"), callback_data="menu:scan")])
-    if cfg_bool("enabled_menu_idea", True):
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_idea", "❓ Нет модели / Хочу придумать"), callback_data="menu:idea")])
-    if cfg_bool("enabled_menu_about", True):
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_about", "ℹ️ О нас"), callback_data="menu:about")])
+    if cfg_bool("enabled_menu_print", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_print", "📐 Рассчитать печать", cfg), callback_data=MenuCB(branch="print").pack())])
+    if cfg_bool("enabled_menu_scan", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_scan", "📡 3D-сканирование", cfg), callback_data=MenuCB(branch="scan").pack())])
+    if cfg_bool("enabled_menu_idea", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_idea", "❓ Нет модели / Хочу придумать", cfg), callback_data=MenuCB(branch="idea").pack())])
+    if cfg_bool("enabled_menu_about", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_menu_about", "ℹ️ О нас", cfg), callback_data=MenuCB(branch="about").pack())])
     if not rows:
-        rows = [[InlineKeyboardButton(text="ℹ️ О нас", callback_data="menu:about")]]
+        rows = [[InlineKeyboardButton(text="ℹ️ О нас", callback_data=MenuCB(branch="about").pack())]]
     return kb(rows)
 
 
-def step_keyboard_for_print(payload: dict[str, Any]) -> InlineKeyboardMarkup:
-    tech = payload.get("technology")
+def menu_kb() -> InlineKeyboardMarkup:
+    return cached_kb("menu", _build_menu_kb)
+
+
+def _build_print_tech_kb(cfg: dict[str, str]) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    if cfg_bool("enabled_print_fdm", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_print_fdm", "🧵 FDM (Пластик)", cfg), callback_data=SetCB(field="technology", value="FDM").pack())])
+    if cfg_bool("enabled_print_resin", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_print_resin", "💧 Фотополимер", cfg), callback_data=SetCB(field="technology", value="Фотополимер").pack())])
+    if cfg_bool("enabled_print_unknown", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_print_unknown", "🤷 Не знаю", cfg), callback_data=SetCB(field="technology", value="Не знаю").pack())])
+    rows.append(nav_row(False))
+    return kb(rows)
+
+
+def _build_scan_type_kb(cfg: dict[str, str]) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    if cfg_bool("enabled_scan_human", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_human", "🧑 Человек", cfg), callback_data=SetCB(field="scan_type", value="Человек").pack())])
+    if cfg_bool("enabled_scan_object", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_object", "📦 Предмет", cfg), callback_data=SetCB(field="scan_type", value="Предмет").pack())])
+    if cfg_bool("enabled_scan_industrial", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_industrial", "🏭 Промышленный объект", cfg), callback_data=SetCB(field="scan_type", value="Промышленный объект").pack())])
+    if cfg_bool("enabled_scan_other", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_other", "🤔 Другое", cfg), callback_data=SetCB(field="scan_type", value="Другое").pack())])
+    rows.append(nav_row(False))
+    return kb(rows)
+
+
+def _build_idea_type_kb(cfg: dict[str, str]) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    if cfg_bool("enabled_idea_photo", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_photo", "✏️ По фото/эскизу", cfg), callback_data=SetCB(field="idea_type", value="По фото/эскизу").pack())])
+    if cfg_bool("enabled_idea_award", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_award", "🏆 Сувенир/Кубок/Медаль", cfg), callback_data=SetCB(field="idea_type", value="Сувенир/Кубок/Медаль").pack())])
+    if cfg_bool("enabled_idea_master", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_master", "📏 Мастер-модель", cfg), callback_data=SetCB(field="idea_type", value="Мастер-модель").pack())])
+    if cfg_bool("enabled_idea_sign", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_sign", "🎨 Вывески", cfg), callback_data=SetCB(field="idea_type", value="Вывески").pack())])
+    if cfg_bool("enabled_idea_other", True, cfg):
+        rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_other", "🤔 Другое", cfg), callback_data=SetCB(field="idea_type", value="Другое").pack())])
+    rows.append(nav_row(False))
+    return kb(rows)
+
+
+def _build_about_kb(cfg: dict[str, str]) -> InlineKeyboardMarkup:
+    rows: list[list[InlineKeyboardButton]] = []
+    rows.append([InlineKeyboardButton(text=get_cfg("btn_about_equipment", "🏭 Оборудование", cfg), callback_data=AboutCB(section="eq").pack())])
+    rows.append([InlineKeyboardButton(text=get_cfg("btn_about_projects", "🖼 Наши проекты", cfg), callback_data=AboutCB(section="projects").pack())])
+    rows.append([InlineKeyboardButton(text=get_cfg("btn_about_contacts", "📞 Контакты", cfg), callback_data=AboutCB(section="contacts").pack())])
+    rows.append([InlineKeyboardButton(text=get_cfg("btn_about_map", "📍 На карте", cfg), callback_data=AboutCB(section="map").pack())])
+    rows.append(nav_row(False))
+    return kb(rows)
+
+
+def _build_material_kb(cfg: dict[str, str], tech: Any) -> InlineKeyboardMarkup:
     if tech == "FDM":
         items = [
             ("btn_mat_petg", "PET-G"),
@@ -131,12 +384,48 @@ def step_keyboard_for_print(payload: dict[str, Any]) -> InlineKeyboardMarkup:
 
     rows: list[list[InlineKeyboardButton]] = []
     for key, label in items:
-        txt = get_cfg(key, label) if key else label
-        rows.append([InlineKeyboardButton(text=txt, callback_data=f"set:material:{label}")])
+        txt = get_cfg(key, label, cfg) if key else label
+        rows.append([InlineKeyboardButton(text=txt, callback_data=SetCB(field="material", value=label).pack())])
     rows.append(nav_row())
     return kb(rows)
 
 
+def _prebuild_keyboards(cfg: dict[str, str]) -> None:
+    # собираем все клавиатуры сразу при смене снимка, а не на первом нажатии пользователя
+    _kb_cache.update(
+        menu=_build_menu_kb(cfg),
+        print_tech=_build_print_tech_kb(cfg),
+        scan_type=_build_scan_type_kb(cfg),
+        idea_type=_build_idea_type_kb(cfg),
+        about=_build_about_kb(cfg),
+    )
+    for tech in ("FDM", "Фотополимер", None):
+        _kb_cache[f"material:{tech}"] = _build_material_kb(cfg, tech)
+
+
+def step_keyboard_for_print(payload: dict[str, Any]) -> InlineKeyboardMarkup:
+    tech = payload.get("technology")
+    if tech not in ("FDM", "Фотополимер"):
+        tech = None
+    return cached_kb(f"material:{tech}", lambda cfg: _build_material_kb(cfg, tech))
+
+
+URL_PREFIXES = ("http://", "https://")
+
+# ref локального фото -> file_id, который Telegram выдал после первой загрузки
+_uploaded_photo_ids: dict[str, str] = {}
+
+
+@lru_cache(maxsize=128)
+def resolve_photo(ref: str) -> str | FSInputFile:
+    if ref.startswith(URL_PREFIXES):
+        return ref
+    p = Path(ref)
+    if p.exists() and p.is_file():
+        return FSInputFile(str(p), chunk_size=UPLOAD_CHUNK_SIZE)
+    return ref
+
+
 async def send_step(
     message: Message,
     text: str,
@@ -146,14 +435,11 @@ async def send_step(
     ref = photo_ref or getattr(settings, "placeholder_photo_path", "")
     if ref:
         try:
-            if ref.startswith("http://") or ref.startswith("https://"):
-                return await message.answer_photo(photo=ref, caption=text, reply_markup=keyboard)
-
-            p = Path(ref)
-            if p.exists() and p.is_file():
-                return await message.answer_photo(photo=FSInputFile(str(p)), caption=text, reply_markup=keyboard)
-
-            return await message.answer_photo(photo=ref, caption=text, reply_markup=keyboard)
+            photo = _uploaded_photo_ids.get(ref) or resolve_photo(ref)
+            sent = await message.answer_photo(photo=photo, caption=text, reply_markup=keyboard)
+            if isinstance(photo, FSInputFile) and sent.photo:
+                _uploaded_photo_ids[ref] = sent.photo[-1].file_id
+            return sent
         except Exception:
             logger.exception("Не удалось отправить фото — отправляю текстом")
 
@@ -171,33 +457,128 @@ async def send_step_cb(
     await cb.answer()
 
 
+BRANCH_TITLES = {"print": "Рассчитать печать", "scan": "3D-сканирование", "idea": "Нет модели / Хочу придумать", "dialog": "Диалог"}
+FIELD_TITLES = {
+    "technology": "Технология",
+    "material": "Материал",
+    "material_custom": "Свой материал",
+    "scan_type": "Тип сканирования",
+    "idea_type": "Категория",
+    "description": "Описание",
+    "file": "Файл",
+}
+
+
 def payload_summary(payload: dict[str, Any]) -> str:
-    branch_map = {"print": "Рассчитать печать", "scan": "3D-сканирование", "idea": "Нет модели / Хочу придумать", "dialog": "Диалог"}
-    field_map = {
-        "technology": "Технология",
-        "material": "Материал",
-        "material_custom": "Свой материал",
-        "scan_type": "Тип сканирования",
-        "idea_type": "Категория",
-        "description": "Описание",
-        "file": "Файл",
-    }
     branch = str(payload.get("branch", ""))
-    parts: list[str] = [f"Тип заявки: {branch_map.get(branch, branch)}"]
-    for k, v in payload.items():
-        if k == "branch" or v in (None, ""):
-            continue
-        parts.append(f"• {field_map.get(k, k)}: {v}")
+    parts: list[str] = [f"Тип заявки: {BRANCH_TITLES.get(branch, branch)}"]
+    # поля анкеты известны заранее — идём по ним в фиксированном порядке
+    parts += [f"• {title}: {v}" for key, title in FIELD_TITLES.items() if (v := payload.get(key)) not in (None, "")]
     return "\n".join(parts)
 
 
-async def persist(state: FSMContext) -> None:
-    data = await state.get_data()
+PERSIST_DEBOUNCE_SECONDS = 0.5
+
+# order_id -> (таймер, снимок payload) черновика, который ещё не записан
+_pending_persist: dict[int, tuple[asyncio.TimerHandle, dict[str, Any]]] = {}
+# order_id -> хэш последнего записанного payload: одинаковый черновик повторно не пишем
+_last_persisted: dict[int, int] = {}
+LAST_PERSISTED_MAX = 10_000
+# отправленные заявки: запоздавший черновик не должен перезаписать итоговый payload
+_finalized_orders: dict[int, None] = {}
+FINALIZED_ORDERS_MAX = 10_000
+
+
+class _OrderLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+_order_locks: dict[int, _OrderLock] = {}
+
+
+@asynccontextmanager
+async def _order_guard(order_id: int) -> AsyncIterator[None]:
+    entry = _order_locks.get(order_id)
+    if entry is None:
+        entry = _order_locks[order_id] = _OrderLock()
+    entry.users += 1
+    try:
+        async with entry.lock:
+            yield
+    finally:
+        entry.users -= 1
+        # никто больше не ждёт — не держим Lock брошенных черновиков
+        if not entry.users:
+            _order_locks.pop(order_id, None)
+
+
+async def _flush_payload(order_id: int, payload: dict[str, Any]) -> None:
+    if order_id in _finalized_orders:
+        return
+    digest = hash(orjson.dumps(payload))
+    if _last_persisted.get(order_id) == digest:
+        return
+    async with _order_guard(order_id):
+        # finalize мог пройти, пока ждали блокировку
+        if order_id in _finalized_orders:
+            return
+        try:
+            await db_call(database.update_order_payload, order_id, payload, payload_summary(payload))
+        except Exception:
+            logger.exception("Не удалось сохранить черновик заявки")
+            return
+    if len(_last_persisted) >= LAST_PERSISTED_MAX:
+        _last_persisted.clear()
+    _last_persisted[order_id] = digest
+
+
+def _start_flush(order_id: int) -> None:
+    pending = _pending_persist.pop(order_id, None)
+    if pending is not None:
+        spawn_background(_flush_payload(order_id, pending[1]))
+
+
+def _cancel_pending_persist(order_id: int) -> None:
+    pending = _pending_persist.pop(order_id, None)
+    if pending is not None:
+        pending[0].cancel()
+
+
+async def flush_pending_persists() -> None:
+    for order_id in list(_pending_persist):
+        pending = _pending_persist.pop(order_id)
+        pending[0].cancel()
+        await _flush_payload(order_id, pending[1])
+
+
+async def persist(state: FSMContext, data: dict[str, Any] | None = None) -> None:
+    if data is None:
+        data = await state.get_data()
     order_id = data.get("order_id")
     if not order_id:
         return
-    payload = data.get("payload", {})
-    database.update_order_payload(int(order_id), payload, payload_summary(payload))
+    order_id = int(order_id)
+    # debounce: серия нажатий заканчивается одним UPDATE с последним payload
+    _cancel_pending_persist(order_id)
+    handle = asyncio.get_running_loop().call_later(PERSIST_DEBOUNCE_SECONDS, _start_flush, order_id)
+    _pending_persist[order_id] = (handle, dict(data.get("payload", {})))
+
+
+async def finalize(order_id: int, summary: str, payload: dict[str, Any]) -> None:
+    _cancel_pending_persist(order_id)
+    async with _order_guard(order_id):
+        await db_call(database.finalize_order, order_id, summary, payload)
+        if len(_finalized_orders) >= FINALIZED_ORDERS_MAX:
+            del _finalized_orders[next(iter(_finalized_orders))]
+        _finalized_orders[order_id] = None
+    _last_persisted.pop(order_id, None)
+
+
+HISTORY_LIMIT = 20
 
 
 def _push_history(state_data: dict[str, Any]) -> list[str]:
@@ -205,7 +586,7 @@ def _push_history(state_data: dict[str, Any]) -> list[str]:
     current = state_data.get("current_step")
     if current:
         history.append(current)
-    return history
+    return history[-HISTORY_LIMIT:]
 
 
 async def show_main(message: Message, state: FSMContext) -> None:
@@ -218,94 +599,71 @@ async def show_main(message: Message, state: FSMContext) -> None:
     )
 
 
-async def start_order(cb: CallbackQuery, state: FSMContext, branch: str) -> None:
-    order_id = database.create_order(cb.from_user.id, user_username(cb.from_user), user_full_name(cb.from_user), branch)
-    await state.set_state(Form.step)
-    await state.update_data(order_id=order_id, payload={"branch": branch}, history=[], current_step=None, waiting_text=None)
-
-
-async def render_step(cb: CallbackQuery, state: FSMContext, step: str, from_back: bool = False) -> None:
-    if not from_back:
-        data = await state.get_data()
-        await state.update_data(history=_push_history(data))
-    await state.update_data(current_step=step, waiting_text=None)
-
-    data = await state.get_data()
-    payload: dict[str, Any] = data.get("payload", {})
-
-    if step == "print_tech":
-        rows: list[list[InlineKeyboardButton]] = []
-        if cfg_bool("enabled_print_fdm", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_print_fdm", "🧵 FDM (Пластик)"), callback_data="set:technology:FDM")])
-        if cfg_bool("enabled_print_resin", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_print_resin", "💧 Фотополимер"), callback_data="set:technology:Фотополимер")])
-        if cfg_bool("enabled_print_unknown", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_print_unknown", "🤷 Не знаю"), callback_data="set:technology:Не знаю")])
-        rows.append(nav_row(False))
-        await send_step_cb(cb, get_cfg("text_print_tech", "🖨 Выберите технологию печати:"), kb(rows), photo_ref_for("photo_print"))
-        return
+async def start_order(cb: CallbackQuery, state: FSMContext, branch: str) -> dict[str, Any]:
+    # INSERT заявки и запись FSM-состояния независимы — выполняем параллельно
+    order_id, _ = await asyncio.gather(
+        db_call(database.create_order, cb.from_user.id, user_username(cb.from_user), user_full_name(cb.from_user), branch),
+        state.set_state(Form.step),
+    )
+    # данные сохраняет render_step первого шага одним set_data
+    return {"order_id": order_id, "payload": {"branch": branch}, "history": [], "current_step": None, "waiting_text": None}
 
-    if step == "print_material":
-        await send_step_cb(cb, get_cfg("text_select_material", "Выберите материал:"), step_keyboard_for_print(payload), photo_ref_for("photo_print"))
-        return
 
-    if step == "print_material_custom":
-        await state.update_data(waiting_text="material_custom")
-        await send_step_cb(cb, get_cfg("text_describe_material", "Опишите материал/смолу свободным текстом:"), kb([nav_row()]), photo_ref_for("photo_print"))
-        return
+WAITING_TEXT_BY_STEP = {"print_material_custom": "material_custom", "description": "description"}
 
-    if step == "attach_file":
-        rows = [[InlineKeyboardButton(text="❌ У меня нет файла", callback_data="set:file:нет")], nav_row()]
-        await send_step_cb(cb, get_cfg("text_attach_file", "Прикрепите STL/3MF/OBJ или фото. Или нажмите кнопку ниже:"), kb(rows))
-        return
 
-    if step == "description":
-        await state.update_data(waiting_text="description")
-        await send_step_cb(cb, get_cfg("text_describe_task", "Опишите задачу, размеры, сроки и важные детали:"), kb([nav_row()]))
-        return
+# step -> (ключ текста, текст по умолчанию, клавиатура по payload, ключ фото)
+STEP_SCREENS: dict[str, tuple[str, str, Callable[[dict[str, Any]], InlineKeyboardMarkup], str | None]] = {
+    "print_tech": ("text_print_tech", "🖨 Выберите технологию печати:", lambda p: cached_kb("print_tech", _build_print_tech_kb), "photo_print"),
+    "print_material": ("text_select_material", "Выберите материал:", step_keyboard_for_print, "photo_print"),
+    "print_material_custom": ("text_describe_material", "Опишите материал/смолу свободным текстом:", lambda p: NAV_KB, "photo_print"),
+    "attach_file": ("text_attach_file", "Прикрепите STL/3MF/OBJ или фото. Или нажмите кнопку ниже:", lambda p: ATTACH_FILE_KB, None),
+    "description": ("text_describe_task", "Опишите задачу, размеры, сроки и важные детали:", lambda p: NAV_KB, None),
+    "scan_type": ("text_scan_type", "📡 Выберите тип объекта для 3D-сканирования:", lambda p: cached_kb("scan_type", _build_scan_type_kb), "photo_scan"),
+    "idea_type": ("text_idea_type", "✏️ Выберите направление:", lambda p: cached_kb("idea_type", _build_idea_type_kb), "photo_idea"),
+    "about": ("about_text", "🏢 Chel3D — 3D-печать, моделирование и сканирование.\nВыберите раздел:", lambda p: cached_kb("about", _build_about_kb), "photo_about"),
+}
 
-    if step == "scan_type":
-        rows: list[list[InlineKeyboardButton]] = []
-        if cfg_bool("enabled_scan_human", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_human", "🧑 Человек"), callback_data="set:scan_type:Человек")])
-        if cfg_bool("enabled_scan_object", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_object", "📦 Предмет"), callback_data="set:scan_type:Предмет")])
-        if cfg_bool("enabled_scan_industrial", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_industrial", "🏭 Промышленный объект"), callback_data="set:scan_type:Промышленный объект")])
-        if cfg_bool("enabled_scan_other", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_scan_other", "🤔 Другое"), callback_data="set:scan_type:Другое")])
-        rows.append(nav_row(False))
-        await send_step_cb(cb, get_cfg("text_scan_type", "📡 Выберите тип объекта для 3D-сканирования:"), kb(rows), photo_ref_for("photo_scan"))
-        return
 
-    if step == "idea_type":
-        rows: list[list[InlineKeyboardButton]] = []
-        if cfg_bool("enabled_idea_photo", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_photo", "✏️ По фото/эскизу"), callback_data="set:idea_type:По фото/эскизу")])
-        if cfg_bool("enabled_idea_award", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_award", "🏆 Сувенир/Кубок/Медаль"), callback_data="set:idea_type:Сувенир/Кубок/Медаль")])
-        if cfg_bool("enabled_idea_master", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_master", "📏 Мастер-модель"), callback_data="set:idea_type:Мастер-модель")])
-        if cfg_bool("enabled_idea_sign", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_sign", "🎨 Вывески"), callback_data="set:idea_type:Вывески")])
-        if cfg_bool("enabled_idea_other", True):
-            rows.append([InlineKeyboardButton(text=get_cfg("btn_idea_other", "🤔 Другое"), callback_data="set:idea_type:Другое")])
-        rows.append(nav_row(False))
-        await send_step_cb(cb, get_cfg("text_idea_type", "✏️ Выберите направление:"), kb(rows), photo_ref_for("photo_idea"))
+async def show_step(
+    message: Message,
+    state: FSMContext,
+    step: str,
+    from_back: bool = False,
+    data: dict[str, Any] | None = None,
+) -> None:
+    # data — уже прочитанное (и, возможно, изменённое) состояние: пишем его одним set_data
+    if data is None:
+        data = await state.get_data()
+    if not from_back:
+        data["history"] = _push_history(data)
+    data["current_step"] = step
+    data["waiting_text"] = WAITING_TEXT_BY_STEP.get(step)
+    await state.set_data(data)
+
+    screen = STEP_SCREENS.get(step)
+    if screen is None:
+        await show_main(message, state)
         return
+    text_key, default_text, keyboard_for, photo_key = screen
+    cfg = bot_cfg()
+    await send_step(
+        message,
+        get_cfg(text_key, default_text, cfg),
+        keyboard_for(data.get("payload", {})),
+        photo_ref_for(photo_key, cfg) if photo_key else None,
+    )
 
-    if step == "about":
-        rows: list[list[InlineKeyboardButton]] = []
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_about_equipment", "🏭 Оборудование"), callback_data="about:eq")])
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_about_projects", "🖼 Наши проекты"), callback_data="about:projects")])
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_about_contacts", "📞 Контакты"), callback_data="about:contacts")])
-        rows.append([InlineKeyboardButton(text=get_cfg("btn_about_map", "📍 На карте"), callback_data="about:map")])
-        rows.append(nav_row(False))
-        await send_step_cb(cb, get_cfg("about_text", "🏢 Chel3D — 3D-печать, моделирование и сканирование.\nВыберите раздел:"), kb(rows), photo_ref_for("photo_about"))
-        return
 
+async def render_step(
+    cb: CallbackQuery,
+    state: FSMContext,
+    step: str,
+    from_back: bool = False,
+    data: dict[str, Any] | None = None,
+) -> None:
     if cb.message:
-        await show_main(cb.message, state)
+        await show_step(cb.message, state, step, from_back, data)
     await cb.answer()
 
 
@@ -318,8 +676,11 @@ async def go_back(cb: CallbackQuery, state: FSMContext) -> None:
         await cb.answer()
         return
     prev = history.pop()
-    await state.update_data(history=history)
-    await render_step(cb, state, prev, from_back=True)
+    data["history"] = history
+    await render_step(cb, state, prev, from_back=True, data=data)
+
+
+ORDER_NOTIFY_TEMPLATE = "🆕 Заявка №{order_id}\n\n{summary}"
 
 
 async def send_order_to_orders_chat(bot: Bot, order_id: int, summary: str) -> None:
@@ -328,23 +689,41 @@ async def send_order_to_orders_chat(bot: Bot, order_id: int, summary: str) -> No
         return
     chat_id = normalize_chat_id(raw_chat)
     try:
-        await bot.send_message(chat_id=chat_id, text=f"🆕 Заявка №{order_id}\n\n{summary}")
+        await bot.send_message(chat_id=chat_id, text=ORDER_NOTIFY_TEMPLATE.format(order_id=order_id, summary=summary))
     except Exception:
         logger.exception("Не удалось отправить заявку в чат заказов")
 
 
-async def submit_order(bot: Bot, message: Message, state: FSMContext) -> None:
-    data = await state.get_data()
+QUEUE_DRAIN_SECONDS = 10
+
+# уведомления о заявках шлёт один фоновый воркер: лимит группы (20/мин) не задерживает ответ пользователю
+_orders_queue: asyncio.Queue[tuple[int, str]] = asyncio.Queue()
+
+
+async def orders_chat_worker(bot: Bot) -> None:
+    while True:
+        order_id, summary = await _orders_queue.get()
+        try:
+            # воркер может ждать лимит группы минутами — снимок к этому времени мог устареть
+            await warm_bot_cfg()
+            await send_order_to_orders_chat(bot, order_id, summary)
+        finally:
+            _orders_queue.task_done()
+
+
+async def submit_order(message: Message, state: FSMContext, data: dict[str, Any] | None = None) -> None:
+    if data is None:
+        data = await state.get_data()
     order_id = int(data.get("order_id", 0) or 0)
     payload: dict[str, Any] = data.get("payload", {})
     summary = payload_summary(payload)
 
     if order_id:
-        database.finalize_order(order_id, summary)
-    await send_order_to_orders_chat(bot, order_id, summary)
+        await finalize(order_id, summary, payload)
+    _orders_queue.put_nowait((order_id, summary))
 
     ok_text = get_cfg("text_submit_ok", "✅ Заявка отправлена! Менеджер скоро напишет вам в этот чат.")
-    await send_step(message, ok_text, kb([nav_row(include_back=False)]))
+    await send_step(message, ok_text, HOME_KB)
     await state.clear()
 
 
@@ -352,22 +731,26 @@ async def on_start(message: Message, state: FSMContext) -> None:
     await show_main(message, state)
 
 
-async def on_menu(cb: CallbackQuery, state: FSMContext) -> None:
-    branch = (cb.data or "").split(":", 1)[1] if cb.data else ""
+FIRST_STEP_BY_BRANCH = {"print": "print_tech", "scan": "scan_type", "idea": "idea_type"}
+
+
+async def on_menu(cb: CallbackQuery, state: FSMContext, callback_data: MenuCB) -> None:
+    branch = callback_data.branch
     if branch == "about":
         await render_step(cb, state, "about")
         return
-    if branch not in {"print", "scan", "idea"}:
+    first_step = FIRST_STEP_BY_BRANCH.get(branch)
+    if first_step is None:
         if cb.message:
             await show_main(cb.message, state)
         await cb.answer()
         return
-    await start_order(cb, state, branch)
-    await render_step(cb, state, {"print": "print_tech", "scan": "scan_type", "idea": "idea_type"}[branch])
+    data = await start_order(cb, state, branch)
+    await render_step(cb, state, first_step, data=data)
 
 
-async def on_nav(cb: CallbackQuery, state: FSMContext) -> None:
-    action = (cb.data or "").split(":", 1)[1]
+async def on_nav(cb: CallbackQuery, state: FSMContext, callback_data: NavCB) -> None:
+    action = callback_data.action
     if action == "menu":
         if cb.message:
             await show_main(cb.message, state)
@@ -379,81 +762,200 @@ async def on_nav(cb: CallbackQuery, state: FSMContext) -> None:
     await cb.answer()
 
 
-async def on_about(cb: CallbackQuery, state: FSMContext) -> None:
-    key = (cb.data or "").split(":", 1)[1]
-    mapping = {
-        "eq": ("about_equipment_text", "photo_about_equipment"),
-        "projects": ("about_projects_text", "photo_about_projects"),
-        "contacts": ("about_contacts_text", "photo_about_contacts"),
-        "map": ("about_map_text", "photo_about_map"),
-    }
-    cfg_key, photo_key = mapping.get(key, ("about_text", "photo_about"))
-    await send_step_cb(cb, get_cfg(cfg_key, "ℹ️ О нас"), kb([nav_row()]), photo_ref_for(photo_key))
-    await persist(state)
+ABOUT_SECTIONS = {
+    "eq": ("about_equipment_text", "photo_about_equipment"),
+    "projects": ("about_projects_text", "photo_about_projects"),
+    "contacts": ("about_contacts_text", "photo_about_contacts"),
+    "map": ("about_map_text", "photo_about_map"),
+}
 
 
-async def on_set(cb: CallbackQuery, state: FSMContext) -> None:
-    parts = (cb.data or "").split(":", 2)
-    if len(parts) < 3:
-        await cb.answer()
-        return
-    _, field, value = parts
+async def on_about(cb: CallbackQuery, state: FSMContext, callback_data: AboutCB) -> None:
+    cfg_key, photo_key = ABOUT_SECTIONS.get(callback_data.section, ("about_text", "photo_about"))
+    cfg = bot_cfg()
+    await send_step_cb(cb, get_cfg(cfg_key, "ℹ️ О нас", cfg), NAV_KB, photo_ref_for(photo_key, cfg))
 
-    st = await state.get_data()
-    payload: dict[str, Any] = st.get("payload", {})
-    payload[field] = value
-    await state.update_data(payload=payload)
-    await persist(state)
 
-    if field == "technology":
-        await render_step(cb, state, "print_material")
-        return
+NEXT_STEP_BY_FIELD = {
+    "technology": "print_material",
+    "material": "attach_file",
+    "scan_type": "description",
+    "idea_type": "description",
+    "file": "description",
+}
 
-    if field == "material":
-        if "🤔" in value:
-            await render_step(cb, state, "print_material_custom")
-            return
-        await render_step(cb, state, "attach_file")
-        return
 
-    if field in {"scan_type", "idea_type"}:
-        await render_step(cb, state, "description")
-        return
+async def on_set(cb: CallbackQuery, state: FSMContext, callback_data: SetCB) -> None:
+    field, value = callback_data.field, callback_data.value
 
-    if field == "file":
-        await render_step(cb, state, "description")
+    st = await state.get_data()
+    payload: dict[str, Any] = st.setdefault("payload", {})
+    payload[field] = value
+    await persist(state, st)
+
+    if field == "material" and "🤔" in value:
+        next_step = "print_material_custom"
+    else:
+        next_step = NEXT_STEP_BY_FIELD.get(field)
+    if next_step:
+        await render_step(cb, state, next_step, data=st)
         return
 
+    await state.update_data(payload=payload)
     await cb.answer()
 
 
-async def on_text(message: Message, state: FSMContext, bot: Bot) -> None:
+async def on_text(message: Message, state: FSMContext) -> None:
     st = await state.get_data()
     waiting = st.get("waiting_text")
     if not waiting:
         return
 
-    payload: dict[str, Any] = st.get("payload", {})
+    payload: dict[str, Any] = st.setdefault("payload", {})
 
     if waiting == "material_custom":
         payload["material_custom"] = (message.text or "").strip()
-        await state.update_data(payload=payload, waiting_text=None)
-        await persist(state)
-        await send_step(message, "Принято ✅", kb([nav_row()]))
+        await persist(state, st)
+        await send_step(message, "Принято ✅", NAV_KB)
         # дальше
-        fake_cb = CallbackQuery(id="0", from_user=message.from_user, chat_instance="0", message=message, data="")
-        await render_step(fake_cb, state, "attach_file")
+        await show_step(message, state, "attach_file", data=st)
         return
 
     if waiting == "description":
         payload["description"] = (message.text or "").strip()
-        await state.update_data(payload=payload, waiting_text=None)
-        await persist(state)
-        await submit_order(bot, message, state)
+        # submit_order пишет итоговый payload вместе со сменой статуса и очищает состояние
+        await submit_order(message, state, st)
+        return
+
+
+def upload_path(order_id: int, name: str) -> Path:
+    return UPLOADS_DIR / f"{order_id}_{Path(name).name}"
+
+
+def spawn_background(coro: Coroutine[Any, Any, None]) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _part_path(dst: Path) -> Path:
+    # уникальное имя: два воркера с одним файлом не пишут в один .part
+    return dst.with_name(f"{dst.name}.{uuid.uuid4().hex[:8]}.part")
+
+
+def _link_or_copy(src: Path, dst: Path, expected_size: int | None) -> bool:
+    if not src.is_file():
+        return False
+    # обрезанную копию (оборванная загрузка) не переиспользуем
+    if expected_size and src.stat().st_size != expected_size:
+        return False
+    if not dst.exists():
+        try:
+            os.link(src, dst)
+        except OSError:
+            tmp = _part_path(dst)
+            try:
+                shutil.copyfile(src, tmp)
+                os.replace(tmp, dst)
+            finally:
+                tmp.unlink(missing_ok=True)
+    return True
+
+
+FILE_ROWS_FLUSH_SECONDS = 0.5
+
+# строки order_files копятся коротким окном: альбом из 10 фото — один INSERT вместо десяти
+_pending_file_rows: list[tuple[int, str, str | None, str | None, str]] = []
+_file_rows_timer: asyncio.TimerHandle | None = None
+
+
+async def flush_file_rows() -> None:
+    global _file_rows_timer
+    if _file_rows_timer is not None:
+        _file_rows_timer.cancel()
+        _file_rows_timer = None
+    rows = _pending_file_rows[:]
+    _pending_file_rows.clear()
+    if not rows:
         return
+    try:
+        await db_call(database.add_order_files, rows)
+    except Exception:
+        logger.exception("Не удалось записать файлы в БД")
+
+
+def _start_file_rows_flush() -> None:
+    global _file_rows_timer
+    _file_rows_timer = None
+    spawn_background(flush_file_rows())
+
+
+def queue_file_row(row: tuple[int, str, str | None, str | None, str]) -> None:
+    global _file_rows_timer
+    _pending_file_rows.append(row)
+    if _file_rows_timer is None:
+        _file_rows_timer = asyncio.get_running_loop().call_later(FILE_ROWS_FLUSH_SECONDS, _start_file_rows_flush)
+
+
+async def store_attachment(
+    bot: Bot,
+    order_id: int,
+    tg_file_id: str,
+    file_unique_id: str | None,
+    file_name: str | None,
+    file_size: int | None,
+) -> None:
+    dst = upload_path(order_id, file_name or tg_file_id)
+    known: dict[str, Any] | None = None
+    if file_unique_id:
+        try:
+            # копию ищем среди других заявок — строка этой заявки пишется отдельно пачкой
+            known = await db_call(database.find_order_file_by_unique_id, file_unique_id, order_id)
+        except Exception:
+            logger.exception("Не удалось найти ранее загруженный файл")
 
+    # тот же файл уже скачивали для другой заявки — берём локальную копию
+    if known:
+        src = upload_path(int(known["order_id"]), known.get("file_name") or known["telegram_file_id"])
+        try:
+            if await asyncio.to_thread(_link_or_copy, src, dst, file_size):
+                return
+        except Exception:
+            logger.exception("Не удалось скопировать локальный файл")
+
+    # качаем во временный файл и переименовываем только целиком скачанный:
+    # под итоговым именем никогда не лежит обрывок, который подхватят другие заявки
+    tmp = _part_path(dst)
+    try:
+        f = await bot.get_file(tg_file_id)
+        await bot.download_file(
+            f.file_path,
+            destination=tmp,
+            timeout=DOWNLOAD_TIMEOUT_SECONDS,
+            chunk_size=DOWNLOAD_CHUNK_SIZE,
+        )
+        size = tmp.stat().st_size
+        if file_size and size != file_size:
+            raise OSError(f"размер {size} вместо {file_size}")
+        os.replace(tmp, dst)
+    except Exception:
+        logger.exception("Не удалось скачать файл локально")
+    finally:
+        tmp.unlink(missing_ok=True)
 
-async def on_file(message: Message, state: FSMContext, bot: Bot) -> None:
+
+async def attachment_worker(bot: Bot) -> None:
+    while True:
+        item = await _attachment_queue.get()
+        try:
+            await store_attachment(bot, *item)
+        except Exception:
+            logger.exception("Не удалось обработать вложение")
+        finally:
+            _attachment_queue.task_done()
+
+
+async def on_file(message: Message, state: FSMContext) -> None:
     st = await state.get_data()
     order_id = int(st.get("order_id", 0) or 0)
     if not order_id:
@@ -463,111 +965,194 @@ async def on_file(message: Message, state: FSMContext, bot: Bot) -> None:
     file_unique_id = None
     file_name = None
     file_type = None
+    file_size = None
 
     if message.document:
         tg_file_id = message.document.file_id
         file_unique_id = message.document.file_unique_id
         file_name = message.document.file_name
         file_type = "document"
+        file_size = message.document.file_size
     elif message.photo:
         tg_file_id = message.photo[-1].file_id
         file_unique_id = message.photo[-1].file_unique_id
         file_name = f"photo_{tg_file_id}.jpg"
         file_type = "photo"
+        file_size = message.photo[-1].file_size
     else:
         return
 
-    try:
-        database.add_order_file(order_id, tg_file_id, file_unique_id, file_name, file_type)
-    except Exception:
-        logger.exception("Не удалось записать файл в БД")
+    queue_file_row((order_id, tg_file_id, file_unique_id, file_name, file_type))
+    # очередь ограничена: при завале пользователь подождёт, а не копятся тысячи задач
+    await _attachment_queue.put((order_id, tg_file_id, file_unique_id, file_name, file_size))
 
-    try:
-        f = await bot.get_file(tg_file_id)
-        dst = UPLOADS_DIR / f"{order_id}_{Path(file_name or tg_file_id).name}"
-        await bot.download_file(f.file_path, destination=dst)
-    except Exception:
-        logger.exception("Не удалось скачать файл локально")
-
-    payload: dict[str, Any] = st.get("payload", {})
+    payload: dict[str, Any] = st.setdefault("payload", {})
     payload["file"] = file_name or "файл"
-    await state.update_data(payload=payload)
-    await persist(state)
+    await persist(state, st)
+    await show_step(message, state, "description", data=st)
 
-    fake_cb = CallbackQuery(id="0", from_user=message.from_user, chat_instance="0", message=message, data="")
-    await render_step(fake_cb, state, "description")
 
+FILE_CONTENT_TYPES = frozenset({ContentType.DOCUMENT, ContentType.PHOTO})
 
-async def handle_internal_send_message(request: web.Request) -> web.Response:
+
+def build_router() -> Router:
+    router = Router(name="chel3d")
+    router.message.register(on_start, CommandStart())
+    # самые частые колбэки первыми: каждый шаг анкеты — set:, затем навигация
+    router.callback_query.register(on_set, SetCB.filter())
+    router.callback_query.register(on_nav, NavCB.filter())
+    router.callback_query.register(on_menu, MenuCB.filter())
+    router.callback_query.register(on_about, AboutCB.filter())
+
+    router.message.register(on_text, F.text)
+    router.message.register(on_file, F.content_type.in_(FILE_CONTENT_TYPES))
+    return router
+
+
+_INTERNAL_KEY = settings.internal_api_key.encode()
+
+
+def _authorized(request: web.Request) -> bool:
     key = request.headers.get("X-Internal-Key", "")
-    if not key or key != settings.internal_api_key:
-        return web.json_response({"detail": "Unauthorized"}, status=401)
+    return bool(key) and bool(_INTERNAL_KEY) and hmac.compare_digest(key.encode(), _INTERNAL_KEY)
+
+
+def json_response(data: Any, status: int = 200) -> web.Response:
+    return web.Response(body=orjson.dumps(data), status=status, content_type="application/json")
+
+
+async def handle_internal_send_message(request: web.Request) -> web.Response:
+    if not _authorized(request):
+        return json_response({"detail": "Unauthorized"}, status=401)
 
     try:
-        data = await request.json()
+        data = orjson.loads(await request.read())
     except Exception:
-        return web.json_response({"detail": "Bad JSON"}, status=400)
+        return json_response({"detail": "Bad JSON"}, status=400)
 
     user_id = int(data.get("user_id", 0) or 0)
     text = str(data.get("text", "") or "").strip()
     order_id = int(data.get("order_id", 0) or 0)
 
     if not user_id or not text:
-        return web.json_response({"detail": "user_id и text обязательны"}, status=400)
+        return json_response({"detail": "user_id и text обязательны"}, status=400)
 
     bot: Bot = request.app["bot"]
     try:
         await bot.send_message(chat_id=user_id, text=text)
     except Exception:
         logger.exception("Не удалось отправить сообщение пользователю")
-        return web.json_response({"detail": "Telegram send failed"}, status=400)
+        return json_response({"detail": "Telegram send failed"}, status=400)
 
     if order_id:
         try:
-            database.add_order_message(order_id, "out", text)
+            await db_call(database.add_order_message, order_id, "out", text)
         except Exception:
             logger.exception("Не удалось сохранить сообщение в БД")
 
-    return web.json_response({"ok": True})
+    return json_response({"ok": True})
+
 
+async def handle_internal_reload_config(request: web.Request) -> web.Response:
+    if not _authorized(request):
+        return json_response({"detail": "Unauthorized"}, status=401)
 
-async def start_internal_api(bot: Bot) -> web.AppRunner:
+    invalidate_bot_cfg()
+    await warm_bot_cfg()
+    return json_response({"ok": True})
+
+
+async def start_internal_api(bot: Bot, dp: Dispatcher) -> web.AppRunner:
     app = web.Application()
     app["bot"] = bot
     app.router.add_post("/internal/sendMessage", handle_internal_send_message)
-
-    runner = web.AppRunner(app)
+    app.router.add_post("/internal/reloadConfig", handle_internal_reload_config)
+    if settings.webhook_url:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=settings.webhook_secret,
+        ).register(app, path=settings.webhook_path)
+        setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
-    site = web.TCPSite(runner, host="0.0.0.0", port=8081)
+    site = web.TCPSite(runner, host="0.0.0.0", port=8081, backlog=512)
     await site.start()
     return runner
 
 
 async def main() -> None:
+    if settings.webhook_url and not settings.webhook_secret:
+        # без секрета публичный webhook примет поддельные апдейты от кого угодно
+        raise RuntimeError("Для режима webhook задайте WEBHOOK_SECRET")
+
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_THREAD_POOL_SIZE, thread_name_prefix="db")
+    )
     database.init_db_if_needed()
+    await warm_bot_cfg()
 
     bot = Bot(token=settings.bot_token)
-    dp = Dispatcher(storage=MemoryStorage())
-
-    dp.message.register(on_start, CommandStart())
-    dp.callback_query.register(on_menu, F.data.startswith("menu:"))
-    dp.callback_query.register(on_nav, F.data.startswith("nav:"))
-    dp.callback_query.register(on_about, F.data.startswith("about:"))
-    dp.callback_query.register(on_set, F.data.startswith("set:"))
-
-    dp.message.register(lambda m, s, b=bot: on_text(m, s, b), F.text)
-    dp.message.register(
-        lambda m, s, b=bot: on_file(m, s, b),
-        F.content_type.in_({ContentType.DOCUMENT, ContentType.PHOTO}),
-    )
+    bot.session.middleware(SendRateLimiter())
+    if settings.redis_url:
+        from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+        from redis.asyncio import ConnectionPool, Redis
+
+        pool = ConnectionPool.from_url(settings.redis_url, max_connections=REDIS_MAX_CONNECTIONS)
+        # bot_id в ключе — несколько ботов/реплик делят один Redis без пересечений
+        storage = RedisStorage(
+            redis=Redis(connection_pool=pool),
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=FSM_TTL,
+            data_ttl=FSM_TTL,
+        )
+    else:
+        storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(bot_cfg_middleware)
 
-    runner = await start_internal_api(bot)
+    dp.include_router(build_router())
+
+    runner = await start_internal_api(bot, dp)
+    workers = [asyncio.create_task(orders_chat_worker(bot))]
+    workers += [asyncio.create_task(attachment_worker(bot)) for _ in range(MAX_PARALLEL_DOWNLOADS)]
 
     try:
-        await dp.start_polling(bot)
+        if settings.webhook_url:
+            await bot.set_webhook(
+                settings.webhook_url.rstrip("/") + settings.webhook_path,
+                secret_token=settings.webhook_secret,
+            )
+            # start_polling ставит обработчики сигналов сам, в режиме webhook — мы,
+            # иначе docker stop убьёт процесс, не дойдя до finally
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+        else:
+            await dp.start_polling(bot)
     finally:
+        await flush_pending_persists()
+        await flush_file_rows()
+        for queue in (_orders_queue, _attachment_queue):
+            try:
+                await asyncio.wait_for(queue.join(), QUEUE_DRAIN_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning("Очередь не разобрана до остановки: осталось %s", queue.qsize())
+        for worker in workers:
+            worker.cancel()
+        # черновики и строки файлов, отложенные таймерами прямо перед остановкой
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+        await flush_file_rows()
         await runner.cleanup()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -21,6 +21,11 @@ class Settings:
     internal_api_port: int = int(os.getenv("INTERNAL_API_PORT", "8081"))
     admin_panel_password: str = os.getenv("ADMIN_PANEL_PASSWORD", "admin123")
     secret_key: str = os.getenv("SECRET_KEY", "change-me")
+    bot_cfg_ttl: float = float(os.getenv("BOT_CFG_TTL", "60"))
+    redis_url: str = os.getenv("REDIS_URL", "")
+    webhook_url: str = os.getenv("WEBHOOK_URL", "")
+    webhook_path: str = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+    webhook_secret: str = os.getenv("WEBHOOK_SECRET", "")
 
 
 settings = Settings()
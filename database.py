@@ -1,8 +1,9 @@
-import json
+import threading
 import time
 from contextlib import contextmanager
-from typing import Any
+from typing import Any, Iterable
 
+import orjson
 import pymysql
 from pymysql.cursors import DictCursor
 
@@ -10,11 +11,32 @@ from config import settings
 
 ALLOWED_STATUSES = {"draft", "new", "submitted", "in_work", "done", "canceled"}
 
+STATUS_LABELS = {
+    "draft": "Черновик",
+    "new": "Новая заявка",
+    "submitted": "Новая заявка",
+    "in_work": "В работе",
+    "done": "Готово",
+    "canceled": "Отменено",
+}
+
+# status -> human label, computed by MySQL while it is already walking the rows
+_STATUS_LABEL_SQL = (
+    "CASE status "
+    + " ".join("WHEN %s THEN %s" for _ in STATUS_LABELS)
+    + " ELSE status END AS status_label"
+)
+_STATUS_LABEL_ARGS = tuple(x for pair in STATUS_LABELS.items() for x in pair)
+
 
 class DatabaseError(Exception):
     pass
 
 
+def dumps_json(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+
 def get_connection(retries: int = 20, delay: float = 1.5):
     last_error: Exception | None = None
     for _ in range(retries):
@@ -35,23 +57,70 @@ def get_connection(retries: int = 20, delay: float = 1.5):
     raise DatabaseError(f"Cannot connect to DB: {last_error}")
 
 
+# One long-lived connection per thread (bot event loop, FastAPI threadpool workers).
+_local = threading.local()
+PING_AFTER_IDLE_SECONDS = 60.0
+
+
+def _thread_connection():
+    conn = getattr(_local, "conn", None)
+    now = time.monotonic()
+    if conn is None:
+        conn = _local.conn = get_connection()
+    elif now - _local.last_used > PING_AFTER_IDLE_SECONDS:
+        conn.ping(reconnect=True)
+    _local.last_used = now
+    return conn
+
+
+def _drop_thread_connection() -> None:
+    conn = getattr(_local, "conn", None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 @contextmanager
 def db_cursor():
-    conn = get_connection()
+    conn = _thread_connection()
     try:
         with conn.cursor() as cur:
             yield conn, cur
         conn.commit()
     except Exception:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except Exception:
+            _drop_thread_connection()
         raise
-    finally:
-        conn.close()
+
+
+# Columns/indexes added after the first release. schema.sql only runs on a fresh volume,
+# so existing databases are brought up to date here; every step is idempotent.
+_MIGRATIONS = (
+    (
+        "SELECT COUNT(*) AS n FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='order_files' AND COLUMN_NAME='file_unique_id'",
+        "ALTER TABLE order_files ADD COLUMN file_unique_id VARCHAR(255) NULL AFTER telegram_file_id",
+    ),
+    (
+        "SELECT COUNT(*) AS n FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='order_files' AND INDEX_NAME='idx_order_files_unique'",
+        "ALTER TABLE order_files ADD INDEX idx_order_files_unique (file_unique_id, created_at)",
+    ),
+)
 
 
 def init_db_if_needed() -> None:
     with db_cursor() as (_, cur):
         cur.execute("SELECT 1")
+        for check_sql, alter_sql in _MIGRATIONS:
+            cur.execute(check_sql)
+            if not cur.fetchone()["n"]:
+                cur.execute(alter_sql)
 
 
 # -----------------------------
@@ -69,16 +138,38 @@ def get_bot_config() -> dict[str, str]:
         return cfg
 
 
-def set_bot_config(key: str, value: str) -> None:
+def get_bot_config_subset(keys: Iterable[str]) -> dict[str, str]:
+    keys = list(keys)
+    if not keys:
+        return {}
     with db_cursor() as (_, cur):
         cur.execute(
-            '''
-            INSERT INTO bot_config (config_key, config_value)
-            VALUES (%s, %s)
-            ON DUPLICATE KEY UPDATE config_value=VALUES(config_value), updated_at=NOW()
-            ''',
-            (key, value),
+            f"SELECT config_key, config_value FROM bot_config WHERE config_key IN ({', '.join(['%s'] * len(keys))})",
+            keys,
+        )
+        rows = cur.fetchall()
+        cfg: dict[str, str] = {}
+        for r in rows:
+            v = r.get("config_value")
+            cfg[str(r.get("config_key", ""))] = "" if v is None else str(v)
+        return cfg
+
+
+def get_bot_config_version() -> str:
+    # updated_at has 1s resolution, so two edits in the same second would keep the token;
+    # the content checksum changes on any edit, whoever wrote it (backend, admin.php)
+    with db_cursor() as (_, cur):
+        cur.execute(
+            "SELECT COUNT(*) AS c, MAX(updated_at) AS m, "
+            "BIT_XOR(CRC32(CONCAT(config_key, '=', COALESCE(config_value, '')))) AS h "
+            "FROM bot_config"
         )
+        row = cur.fetchone() or {}
+        return f"{row.get('c', 0)}:{row.get('m')}:{row.get('h')}"
+
+
+def set_bot_config(key: str, value: str) -> None:
+    set_bot_config_many({key: value})
 
 
 def set_bot_config_many(items: dict[str, str]) -> None:
@@ -106,7 +197,7 @@ def create_order(user_id: int, username: str | None, full_name: str | None, bran
             INSERT INTO orders (user_id, username, full_name, branch, status, order_payload, updated_at)
             VALUES (%s, %s, %s, %s, 'draft', %s, NOW())
             ''',
-            (user_id, username, full_name, branch, json.dumps(payload, ensure_ascii=False)),
+            (user_id, username, full_name, branch, dumps_json(payload)),
         )
         return int(cur.lastrowid)
 
@@ -141,7 +232,7 @@ def find_or_create_active_order(user_id: int, username: str | None, full_name: s
             INSERT INTO orders (user_id, username, full_name, branch, status, order_payload, updated_at)
             VALUES (%s, %s, %s, 'dialog', 'new', %s, NOW())
             ''',
-            (user_id, username, full_name, json.dumps({"branch": "dialog"}, ensure_ascii=False)),
+            (user_id, username, full_name, dumps_json({"branch": "dialog"})),
         )
         return int(cur.lastrowid)
 
@@ -162,11 +253,11 @@ def update_order_payload(order_id: int, payload: dict[str, Any], summary: str |
             SET order_payload=%s, summary=%s, updated_at=NOW()
             WHERE id=%s
             ''',
-            (json.dumps(payload, ensure_ascii=False), summary, order_id),
+            (dumps_json(payload), summary, order_id),
         )
 
 
-def finalize_order(order_id: int, summary: str | None = None) -> None:
+def finalize_order(order_id: int, summary: str | None = None, payload: dict[str, Any] | None = None) -> None:
     with db_cursor() as (_, cur):
         cur.execute("SELECT status FROM orders WHERE id=%s", (order_id,))
         row = cur.fetchone()
@@ -176,23 +267,29 @@ def finalize_order(order_id: int, summary: str | None = None) -> None:
         new_status = "new" if status in ("draft", "", None) else str(status)
         if new_status not in ALLOWED_STATUSES:
             new_status = "new"
-        cur.execute(
-            "UPDATE orders SET status=%s, summary=%s, updated_at=NOW() WHERE id=%s",
-            (new_status, summary, order_id),
-        )
+        if payload is None:
+            cur.execute(
+                "UPDATE orders SET status=%s, summary=%s, updated_at=NOW() WHERE id=%s",
+                (new_status, summary, order_id),
+            )
+        else:
+            cur.execute(
+                "UPDATE orders SET status=%s, summary=%s, order_payload=%s, updated_at=NOW() WHERE id=%s",
+                (new_status, summary, dumps_json(payload), order_id),
+            )
 
 
 def list_orders(status: str | None = None, limit: int = 200, offset: int = 0) -> list[dict[str, Any]]:
     with db_cursor() as (_, cur):
         if status:
             cur.execute(
-                "SELECT * FROM orders WHERE status=%s ORDER BY created_at DESC LIMIT %s OFFSET %s",
-                (status, limit, offset),
+                f"SELECT *, {_STATUS_LABEL_SQL} FROM orders WHERE status=%s ORDER BY created_at DESC LIMIT %s OFFSET %s",
+                (*_STATUS_LABEL_ARGS, status, limit, offset),
             )
         else:
             cur.execute(
-                "SELECT * FROM orders ORDER BY created_at DESC LIMIT %s OFFSET %s",
-                (limit, offset),
+                f"SELECT *, {_STATUS_LABEL_SQL} FROM orders ORDER BY created_at DESC LIMIT %s OFFSET %s",
+                (*_STATUS_LABEL_ARGS, limit, offset),
             )
         return [dict(r) for r in cur.fetchall()]
 
@@ -214,7 +311,7 @@ def get_order_statistics() -> dict[str, int]:
 
 def get_order(order_id: int) -> dict[str, Any] | None:
     with db_cursor() as (_, cur):
-        cur.execute("SELECT * FROM orders WHERE id=%s", (order_id,))
+        cur.execute(f"SELECT *, {_STATUS_LABEL_SQL} FROM orders WHERE id=%s", (*_STATUS_LABEL_ARGS, order_id))
         row = cur.fetchone()
         return dict(row) if row else None
 
@@ -259,16 +356,33 @@ def add_order_file(
     file_name: str | None,
     file_type: str | None,
 ) -> None:
+    add_order_files([(order_id, telegram_file_id, file_unique_id, file_name, file_type)])
+
+
+def add_order_files(rows: Iterable[tuple[int, str, str | None, str | None, str | None]]) -> None:
+    rows = list(rows)
+    if not rows:
+        return
     with db_cursor() as (_, cur):
-        cur.execute(
+        cur.executemany(
             '''
             INSERT INTO order_files (order_id, telegram_file_id, file_unique_id, file_name, file_type, created_at)
             VALUES (%s, %s, %s, %s, %s, NOW())
             ''',
-            (order_id, telegram_file_id, file_unique_id, file_name, file_type),
+            rows,
         )
 
 
+def find_order_file_by_unique_id(file_unique_id: str, exclude_order_id: int = 0) -> dict[str, Any] | None:
+    with db_cursor() as (_, cur):
+        cur.execute(
+            "SELECT * FROM order_files WHERE file_unique_id=%s AND order_id<>%s ORDER BY created_at DESC LIMIT 1",
+            (file_unique_id, exclude_order_id),
+        )
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
 def list_order_files(order_id: int) -> list[dict[str, Any]]:
     with db_cursor() as (_, cur):
         cur.execute("SELECT * FROM order_files WHERE order_id=%s ORDER BY created_at DESC", (order_id,))
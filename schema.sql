@@ -18,6 +18,7 @@ CREATE TABLE IF NOT EXISTS order_files (
   id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
   order_id BIGINT UNSIGNED NOT NULL,
   telegram_file_id VARCHAR(255) NOT NULL,
+  file_unique_id VARCHAR(255) NULL,
   telegram_message_id BIGINT NULL,
   original_name VARCHAR(255) NOT NULL,
   mime_type VARCHAR(255) NULL,
@@ -26,6 +27,7 @@ CREATE TABLE IF NOT EXISTS order_files (
   created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (id),
   KEY idx_order_files_order (order_id),
+  KEY idx_order_files_unique (file_unique_id, created_at),
   CONSTRAINT fk_order_files_order FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 